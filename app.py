@@ -1,9 +1,15 @@
 import os
 import uuid
-import base64
+import multiprocessing
+import mimetypes
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import click
 from flask import (
     Flask,
     render_template,
@@ -12,6 +18,9 @@ from flask import (
     request,
     jsonify,
     flash,
+    g,
+    send_from_directory,
+    abort,
 )
 from flask_login import (
     LoginManager,
@@ -21,7 +30,27 @@ from flask_login import (
     logout_user,
     current_user,
 )
-from flask_bcrypt import Bcrypt
+from werkzeug.security import safe_join
+
+import passwords
+
+# Optional: SIMD-accelerated base64 codec, same API as the stdlib module
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# Optional: faster JSON encoding for the history response
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: gzip/brotli compression of text responses
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
 
 # Optional: backend Gemini integration (stubbed by default)
 try:
@@ -29,31 +58,195 @@ try:
 except ImportError:
     genai = None
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "app.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "app.db"))
+IMAGE_DIR = os.getenv("IMAGE_DIR", os.path.join(os.path.dirname(__file__), "images"))
+IMAGE_URL_PREFIX = "/images/"
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+_DATA_URL_RE = re.compile(rb"^data:([^;,]+);base64,")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", os.cpu_count() or 1))
+# Name of an image_ops kernel ("dither", "threshold") applied to every
+# generated image, or unset to leave outputs untouched.
+IMAGE_POSTPROCESS = os.getenv("IMAGE_POSTPROCESS")
+
+# Only load numpy/Pillow/numba when post-processing is switched on, and fail
+# at startup rather than per request if it is misconfigured.
+if IMAGE_POSTPROCESS:
+    import image_ops
+
+    if IMAGE_POSTPROCESS not in image_ops.KERNELS:
+        raise RuntimeError(
+            f"Unknown IMAGE_POSTPROCESS {IMAGE_POSTPROCESS!r}; "
+            f"expected one of {sorted(image_ops.KERNELS)}"
+        )
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret-change-me")
+# bcrypt cost is exponential: 10 rounds is ~4x cheaper than the library
+# default of 12. Existing hashes are upgraded/downgraded on next login.
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS", 10))
+# Images are already compressed (PNG/JPEG) and are cached by the browser, so
+# only text responses such as the history JSON are worth compressing.
+app.config["COMPRESS_MIMETYPES"] = [
+    "application/json",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+]
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+
+if Compress:
+    Compress(app)
 
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
-bcrypt = Bcrypt(app)
-
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
 if genai and GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
-    GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
-    gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-else:
-    gemini_model = None
 
+# One client per process, shared by all request threads so its connection
+# is reused. Created on first use because gRPC channels don't survive fork.
+gemini_model = None
+_gemini_model_lock = threading.Lock()
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+
+def get_gemini_model():
+    global gemini_model
+    if not (genai and GEMINI_API_KEY):
+        return None
+    with _gemini_model_lock:
+        if gemini_model is None:
+            gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return gemini_model
+
+
+# SQL used on request paths. Pooled connections keep these prepared in their
+# statement cache across requests.
+# User lookups select exactly the User(...) constructor arguments, in order.
+SQL_USER_BY_ID = (
+    "SELECT id, username, password_hash, is_teacher FROM users WHERE id = ?"
+)
+SQL_USER_BY_USERNAME = (
+    "SELECT id, username, password_hash, is_teacher FROM users WHERE username = ?"
+)
+SQL_USER_COUNT = "SELECT COUNT(*) AS c FROM users"
+# UTC ISO-8601 timestamp generated by SQLite; sorts correctly as text.
+SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+SQL_INSERT_USER = (
+    "INSERT INTO users (username, password_hash, is_teacher) VALUES (?, ?, ?)"
+)
+SQL_UPDATE_PASSWORD = "UPDATE users SET password_hash = ? WHERE id = ?"
+SQL_CLASS_OVERVIEW = """
+    SELECT id, username, is_teacher, convo_count
+    FROM users
+    ORDER BY is_teacher DESC, username ASC
+"""
+SQL_CONVOS_BY_USER = """
+    SELECT prompt, input_image, output_image, model_response_text, created_at
+    FROM conversations
+    WHERE user_id = ?
+    ORDER BY created_at ASC
+"""
+SQL_HISTORY = """
+    SELECT id, prompt, input_image, output_image, model_response_text, created_at
+    FROM conversations
+    WHERE user_id = ?
+    ORDER BY created_at ASC
+"""
+# Whether the given user (or any teacher) has a conversation using an image.
+SQL_IMAGE_ACCESS = """
+    SELECT 1 FROM conversations
+    WHERE (input_image = ? OR output_image = ?) AND (user_id = ? OR ?)
+    LIMIT 1
+"""
+SQL_INSERT_CONVO = f"""
+    INSERT INTO conversations
+    (user_id, prompt, input_image, output_image, model_response_text, created_at)
+    VALUES (?, ?, ?, ?, ?, {SQL_NOW})
+    RETURNING id, created_at
+"""
+
+
+def _make_conn():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
     return conn
 
 
+def init_pool(size=DB_POOL_SIZE):
+    """
+    (Re)create the process-wide connection pool.
+
+    Slots start empty and are filled with a real connection the first time
+    they are checked out, so idle workers don't hold open file handles.
+    """
+    global db_pool
+    db_pool = queue.Queue(maxsize=size)
+    for _ in range(size):
+        db_pool.put(None)
+
+
+def close_pool():
+    """Close every pooled connection. Only call while none are checked out."""
+    for conn in list(db_pool.queue):
+        if conn is not None:
+            conn.close()
+    init_pool(db_pool.maxsize)
+
+
+def _checkout_conn():
+    conn = db_pool.get(timeout=DB_POOL_TIMEOUT)
+    if conn is None:
+        try:
+            conn = _make_conn()
+        except Exception:
+            db_pool.put(None)
+            raise
+    return conn
+
+
+def _release_conn(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    db_pool.put(conn)
+
+
+def get_db():
+    """
+    Return the connection bound to the current app context.
+
+    The first call in a request checks a connection out of the pool; it is
+    handed back by close_db() when the app context is torn down.
+    """
+    if "db" not in g:
+        g.db = _checkout_conn()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        _release_conn(conn)
+
+
+init_pool()
+
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
@@ -63,14 +256,15 @@ def init_db():
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            is_teacher INTEGER NOT NULL DEFAULT 0
+            password_hash BLOB NOT NULL,
+            is_teacher INTEGER NOT NULL DEFAULT 0,
+            convo_count INTEGER NOT NULL DEFAULT 0
         )
         """
     )
 
     cur.execute(
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS conversations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -78,14 +272,76 @@ def init_db():
             input_image TEXT,
             output_image TEXT,
             model_response_text TEXT,
-            created_at TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT ({SQL_NOW}),
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
         """
     )
 
+    # created_at is an ISO-8601 string, so it sorts correctly as text and
+    # per-user history can be read straight off this index.
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_convos_user_time
+        ON conversations(user_id, created_at)
+        """
+    )
+    # Image requests are authorized by looking up the owning conversation.
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_convos_input_image
+        ON conversations(input_image)
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_convos_output_image
+        ON conversations(output_image)
+        """
+    )
+
+    # users.convo_count is kept in step by triggers so the teacher panel
+    # doesn't have to aggregate the whole conversations table.
+    columns = {r["name"] for r in cur.execute("PRAGMA table_info(users)")}
+    added_convo_count = False
+    if "convo_count" not in columns:
+        try:
+            cur.execute(
+                "ALTER TABLE users ADD COLUMN convo_count INTEGER NOT NULL DEFAULT 0"
+            )
+            added_convo_count = True
+        except sqlite3.OperationalError:
+            pass  # another worker added it first
+
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_convo_ins
+        AFTER INSERT ON conversations
+        BEGIN
+            UPDATE users SET convo_count = convo_count + 1 WHERE id = NEW.user_id;
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_convo_del
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE users SET convo_count = convo_count - 1 WHERE id = OLD.user_id;
+        END
+        """
+    )
+
+    if added_convo_count:
+        cur.execute(
+            """
+            UPDATE users SET convo_count = (
+                SELECT COUNT(*) FROM conversations c WHERE c.user_id = users.id
+            )
+            """
+        )
+
     conn.commit()
-    conn.close()
 
 
 class User(UserMixin):
@@ -102,51 +358,181 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
+    # Memoized for the lifetime of the request so repeated lookups don't
+    # hit the database again.
+    cache = g.setdefault("_user_cache", {})
+    if user_id in cache:
+        return cache[user_id]
+
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        return User(
-            id=row["id"],
-            username=row["username"],
-            password_hash=row["password_hash"],
-            is_teacher=row["is_teacher"],
-        )
-    return None
+    row = conn.execute(SQL_USER_BY_ID, (user_id,)).fetchone()
+    user = User(*row) if row else None
+    cache[user_id] = user
+    return user
 
 
-# Initialize DB at startup
+# Initialize DB and image storage at startup. The connection used for this
+# is closed again so that a preloading server (see gunicorn.conf.py) never
+# forks with an open SQLite handle.
 with app.app_context():
     init_db()
+close_pool()
+os.makedirs(IMAGE_DIR, exist_ok=True)
+
+
+# Hashing runs in a small, bounded pool (AUTH_WORKERS) so a burst of logins
+# can't take more cores than that, however many request threads are busy.
+# pyca bcrypt releases the GIL while hashing, so this is about capping CPU,
+# not the GIL. The pooled functions live in passwords.py, which imports only
+# bcrypt, so the children never import this module. They come from a
+# forkserver rather than fork(): the pool is created from a request thread,
+# and forking a threaded process can deadlock and would hand the children our
+# open SQLite handles.
+auth_executor = None
+_auth_executor_lock = threading.Lock()
+
+
+def get_auth_executor():
+    global auth_executor
+    with _auth_executor_lock:
+        if auth_executor is None:
+            auth_executor = ProcessPoolExecutor(
+                max_workers=AUTH_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+    return auth_executor
+
+
+def _run_auth(fn, *args):
+    """Run fn in the auth pool, replacing the pool once if a child died."""
+    global auth_executor
+    executor = get_auth_executor()
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool:
+        with _auth_executor_lock:
+            if auth_executor is executor:
+                auth_executor = None
+        executor.shutdown(wait=False)
+        return get_auth_executor().submit(fn, *args).result()
+
+
+def hash_password(password):
+    rounds = app.config["BCRYPT_LOG_ROUNDS"]
+    return _run_auth(passwords.hash_password, password, rounds)
+
+
+def check_password(password_hash, password):
+    return _run_auth(passwords.check_password, password_hash, password)
+
+
+def hash_rounds(password_hash):
+    """Return the cost factor embedded in a bcrypt hash ("$2b$<rounds>$...")."""
+    if isinstance(password_hash, bytes):
+        password_hash = password_hash.decode("utf-8")
+    try:
+        return int(password_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
 
 
 def get_user_count():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM users")
-    count = cur.fetchone()["c"]
-    conn.close()
-    return count
+    if "user_count" not in g:
+        g.user_count = get_db().execute(SQL_USER_COUNT).fetchone()["c"]
+    return g.user_count
+
+
+def _b64dec(data) -> bytes:
+    # validate=True: reject stray characters instead of silently dropping
+    # them. binascii.Error is a ValueError.
+    return base64.b64decode(data, validate=True)
+
+
+def new_image_path(mime_type: str) -> str:
+    """Return a fresh, unused file path under IMAGE_DIR for an image."""
+    name = uuid.uuid4().hex + IMAGE_EXTENSIONS.get(mime_type, ".bin")
+    return os.path.join(IMAGE_DIR, name)
+
+
+def save_image(image_bytes: bytes, mime_type: str) -> str:
+    """Write an image under IMAGE_DIR and return its path."""
+    path = new_image_path(mime_type)
+    with open(path, "wb") as f:
+        f.write(image_bytes)
+    return path
+
 
+def image_url(path: str) -> str:
+    return IMAGE_URL_PREFIX + os.path.basename(path)
 
-def generate_image_from_sketch(image_bytes: bytes, mime_type: str, prompt: str) -> dict:
+
+def image_path_from_url(url: str):
+    """Map a URL returned by image_url() back to its file, or None."""
+    if not url.startswith(IMAGE_URL_PREFIX):
+        return None
+    path = safe_join(IMAGE_DIR, url[len(IMAGE_URL_PREFIX):])
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def remove_images(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def can_access_image(url: str) -> bool:
+    """True if current_user owns a conversation using this image, or is a teacher."""
+    row = get_db().execute(
+        SQL_IMAGE_ACCESS,
+        (url, url, int(current_user.id), 1 if current_user.is_teacher else 0),
+    ).fetchone()
+    return row is not None
+
+
+def parse_data_url(data_url: str):
+    """Split a base64 data URL into (mime_type, raw bytes); raise ValueError if malformed."""
+    buf = data_url.encode("ascii", "ignore")
+    match = _DATA_URL_RE.match(buf)
+    if not match:
+        raise ValueError("Invalid data URL")
+    # Decode straight from the encoded buffer without slicing out a copy.
+    image_bytes = _b64dec(memoryview(buf)[match.end():])
+    if not image_bytes:
+        raise ValueError("Empty data URL")
+    return match.group(1).decode("ascii"), image_bytes
+
+
+def generate_image_from_sketch(image_path: str, mime_type: str, prompt: str) -> dict:
     """
     Plug your real Gemini logic here.
 
-    The function should return:
+    image_path points at the input image under IMAGE_DIR. Use the shared
+    client from get_gemini_model() rather than creating one per call. The
+    function should return:
         {
-            "image_base64": "<base64 of output image>",
+            "image_path": "<output image under IMAGE_DIR, e.g. from save_image()>",
             "image_mime_type": "image/png",
             "text": "optional model text response",
         }
 
+    Raise ValueError if the input is not a usable image.
+
+    Images stay on disk; the routes only store their URLs, so nothing is
+    read into memory or base64-encoded unless the model needs it.
+
     Currently this is a stub that just echoes the input image.
     """
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
+    if IMAGE_POSTPROCESS:
+        png_bytes = image_ops.postprocess_image(image_path, IMAGE_POSTPROCESS)
+        image_path = save_image(png_bytes, "image/png")
+        mime_type = "image/png"
+
     return {
-        "image_base64": encoded,
+        "image_path": image_path,
         "image_mime_type": mime_type,
         "text": f"(Stub) Model response for prompt: {prompt}",
     }
@@ -165,11 +551,7 @@ def login():
     if current_user.is_authenticated:
         return redirect(url_for("dashboard"))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM users")
-    user_count = cur.fetchone()["c"]
-    conn.close()
+    user_count = get_user_count()
 
     if request.method == "POST":
         username = (request.form.get("username") or "").strip()
@@ -180,19 +562,23 @@ def login():
             return render_template("login.html", user_count=user_count)
 
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE username = ?", (username,))
-        row = cur.fetchone()
-        conn.close()
+        row = conn.execute(SQL_USER_BY_USERNAME, (username,)).fetchone()
 
-        if not row or not bcrypt.check_password_hash(row["password_hash"], password):
+        if not row or not check_password(row["password_hash"], password):
             flash("Invalid username or password.", "error")
             return render_template("login.html", user_count=user_count)
 
+        password_hash = row["password_hash"]
+        if hash_rounds(password_hash) != app.config["BCRYPT_LOG_ROUNDS"]:
+            # Re-hash at the configured cost now that we have the plaintext.
+            password_hash = hash_password(password)
+            with conn:
+                conn.execute(SQL_UPDATE_PASSWORD, (password_hash, row["id"]))
+
         user = User(
             id=row["id"],
             username=row["username"],
-            password_hash=row["password_hash"],
+            password_hash=password_hash,
             is_teacher=row["is_teacher"],
         )
         login_user(user)
@@ -235,17 +621,15 @@ def register():
         if first_user:
             is_teacher = True  # first user is always teacher
 
-        password_hash = bcrypt.generate_password_hash(password).decode("utf-8")
+        password_hash = hash_password(password)
 
         try:
             conn = get_db()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO users (username, password_hash, is_teacher) VALUES (?, ?, ?)",
-                (username, password_hash, 1 if is_teacher else 0),
-            )
-            conn.commit()
-            conn.close()
+            with conn:
+                conn.execute(
+                    SQL_INSERT_USER, (username, password_hash, 1 if is_teacher else 0)
+                )
+            g.pop("user_count", None)
         except sqlite3.IntegrityError:
             flash("Username already exists. Choose another one.", "error")
             return render_template("register.html", first_user=first_user)
@@ -278,20 +662,7 @@ def teacher_panel():
         flash("Teacher access required.", "error")
         return redirect(url_for("dashboard"))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT u.id, u.username, u.is_teacher,
-               COUNT(c.id) AS convo_count
-        FROM users u
-        LEFT JOIN conversations c ON u.id = c.user_id
-        GROUP BY u.id, u.username, u.is_teacher
-        ORDER BY u.is_teacher DESC, u.username ASC
-        """
-    )
-    users = cur.fetchall()
-    conn.close()
+    users = get_db().execute(SQL_CLASS_OVERVIEW).fetchall()
 
     return render_template("teacher.html", users=users)
 
@@ -304,24 +675,12 @@ def teacher_user_view(user_id):
         return redirect(url_for("dashboard"))
 
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cur.fetchone()
+    user = conn.execute(SQL_USER_BY_ID, (user_id,)).fetchone()
     if not user:
-        conn.close()
         flash("User not found.", "error")
         return redirect(url_for("teacher_panel"))
 
-    cur.execute(
-        """
-        SELECT * FROM conversations
-        WHERE user_id = ?
-        ORDER BY datetime(created_at) ASC
-        """,
-        (user_id,),
-    )
-    convos = cur.fetchall()
-    conn.close()
+    convos = conn.execute(SQL_CONVOS_BY_USER, (user_id,)).fetchall()
 
     return render_template(
         "teacher_user.html",
@@ -333,19 +692,7 @@ def teacher_user_view(user_id):
 @app.route("/api/my_history")
 @login_required
 def api_my_history():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, prompt, input_image, output_image, model_response_text, created_at
-        FROM conversations
-        WHERE user_id = ?
-        ORDER BY datetime(created_at) ASC
-        """,
-        (int(current_user.id),),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = get_db().execute(SQL_HISTORY, (int(current_user.id),)).fetchall()
 
     history = []
     for r in rows:
@@ -359,6 +706,10 @@ def api_my_history():
                 "createdAt": r["created_at"],
             }
         )
+    if orjson:
+        # History is the largest JSON payload; the rest of the app keeps
+        # Flask's own JSON provider.
+        return app.response_class(orjson.dumps(history), mimetype="application/json")
     return jsonify(history)
 
 
@@ -373,51 +724,18 @@ def api_initial():
     if not prompt:
         return jsonify({"error": "Missing prompt"}), 400
 
-    image_bytes = sketch_file.read()
     mime_type = sketch_file.mimetype or "image/png"
 
-    result = generate_image_from_sketch(image_bytes, mime_type, prompt)
-
-    input_data_url = (
-        f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
-    )
-    output_data_url = (
-        f"data:{result['image_mime_type']};base64,{result['image_base64']}"
-    )
-
-    created_at = datetime.utcnow().isoformat()
-
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO conversations
-        (user_id, prompt, input_image, output_image, model_response_text, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (
-            int(current_user.id),
-            prompt,
-            input_data_url,
-            output_data_url,
-            result.get("text"),
-            created_at,
-        ),
-    )
-    convo_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+    # Stream the upload straight to its final location instead of reading
+    # it into memory.
+    input_path = new_image_path(mime_type)
+    try:
+        sketch_file.save(input_path)
+    except Exception:
+        remove_images(input_path)
+        raise
 
-    return jsonify(
-        {
-            "id": convo_id,
-            "prompt": prompt,
-            "inputImage": input_data_url,
-            "outputImage": output_data_url,
-            "modelResponseText": result.get("text"),
-            "createdAt": created_at,
-        }
-    )
+    return record_turn(input_path, mime_type, prompt, new_files=[input_path])
 
 
 @app.route("/api/continue", methods=["POST"])
@@ -425,62 +743,145 @@ def api_initial():
 def api_continue():
     data = request.get_json(force=True) or {}
     prompt = (data.get("prompt") or "").strip()
-    last_image_data_url = data.get("lastImage")
+    last_image = data.get("lastImage")
 
     if not prompt:
         return jsonify({"error": "Missing prompt"}), 400
-    if not last_image_data_url:
-        return jsonify({"error": "Missing lastImage (data URL)"}), 400
+    if not last_image:
+        return jsonify({"error": "Missing lastImage"}), 400
+
+    new_files = []
+    if last_image.startswith(IMAGE_URL_PREFIX):
+        # Image previously stored by us: reference the same file, as long as
+        # it still exists and belongs to this user.
+        image_path = image_path_from_url(last_image)
+        if not image_path or not can_access_image(last_image):
+            return jsonify({"error": "Invalid lastImage"}), 400
+        mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
+    else:
+        # Older history entries still hold data URLs.
+        try:
+            mime_type, image_bytes = parse_data_url(last_image)
+        except ValueError:
+            return jsonify({"error": "Invalid lastImage data URL"}), 400
 
-    try:
-        header, b64data = last_image_data_url.split(",", 1)
-        mime_type = header.split(";")[0].split(":")[1]
-    except Exception:
-        return jsonify({"error": "Invalid lastImage data URL"}), 400
+        image_path = save_image(image_bytes, mime_type)
+        new_files.append(image_path)
 
-    image_bytes = base64.b64decode(b64data)
+    return record_turn(image_path, mime_type, prompt, new_files=new_files)
 
-    result = generate_image_from_sketch(image_bytes, mime_type, prompt)
 
-    output_data_url = (
-        f"data:{result['image_mime_type']};base64,{result['image_base64']}"
-    )
+def record_turn(image_path, mime_type, prompt, new_files):
+    """
+    Run generation on image_path and store the turn for current_user.
+
+    new_files lists images written for this request; they are deleted if
+    generation or the insert fails so no unreferenced files are left behind.
+    """
+    try:
+        result = generate_image_from_sketch(image_path, mime_type, prompt)
+        if result["image_path"] != image_path:
+            new_files.append(result["image_path"])
 
-    created_at = datetime.utcnow().isoformat()
+        input_url = image_url(image_path)
+        output_url = image_url(result["image_path"])
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO conversations
-        (user_id, prompt, input_image, output_image, model_response_text, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (
-            int(current_user.id),
-            prompt,
-            last_image_data_url,
-            output_data_url,
-            result.get("text"),
-            created_at,
-        ),
-    )
-    convo_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+        conn = get_db()
+        with conn:
+            row = conn.execute(
+                SQL_INSERT_CONVO,
+                (
+                    int(current_user.id),
+                    prompt,
+                    input_url,
+                    output_url,
+                    result.get("text"),
+                ),
+            ).fetchone()
+    except ValueError:
+        remove_images(*new_files)
+        return jsonify({"error": "Invalid image"}), 400
+    except Exception:
+        remove_images(*new_files)
+        raise
 
     return jsonify(
         {
-            "id": convo_id,
+            "id": row["id"],
             "prompt": prompt,
-            "inputImage": last_image_data_url,
-            "outputImage": output_data_url,
+            "inputImage": input_url,
+            "outputImage": output_url,
             "modelResponseText": result.get("text"),
-            "createdAt": created_at,
+            "createdAt": row["created_at"],
         }
     )
 
 
+@app.route(IMAGE_URL_PREFIX + "<name>")
+@login_required
+def image_file(name):
+    if not can_access_image(IMAGE_URL_PREFIX + name):
+        abort(404)
+
+    # Stored file names are random and never reused, so the browser may
+    # cache them indefinitely; ETag/Last-Modified still allow 304s.
+    response = send_from_directory(
+        IMAGE_DIR, name, conditional=True, max_age=31536000
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.cli.command("migrate-images")
+def migrate_images_command():
+    """Move images still stored inline as data URLs into IMAGE_DIR."""
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, input_image, output_image FROM conversations
+        WHERE input_image LIKE 'data:%' OR output_image LIKE 'data:%'
+        """
+    )
+
+    updates = []
+    converted = 0
+    for row in rows:
+        # The stub echoes its input, so both columns often hold the same data
+        # URL; write it once and point both at the same file.
+        seen = {}
+        urls = []
+        for value in (row["input_image"], row["output_image"]):
+            if value in seen:
+                urls.append(seen[value])
+                continue
+            url = value
+            if value and value.startswith("data:"):
+                try:
+                    mime_type, image_bytes = parse_data_url(value)
+                except ValueError:
+                    pass
+                else:
+                    url = image_url(save_image(image_bytes, mime_type))
+                    converted += 1
+            seen[value] = url
+            urls.append(url)
+        if urls != [row["input_image"], row["output_image"]]:
+            updates.append((*urls, row["id"]))
+
+    # One transaction for the whole batch instead of a commit per row.
+    with conn:
+        conn.executemany(
+            "UPDATE conversations SET input_image = ?, output_image = ? WHERE id = ?",
+            updates,
+        )
+
+    click.echo(f"Migrated {converted} image(s) in {len(updates)} conversation(s).")
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    # Development server only; production runs under gunicorn (see
+    # gunicorn.conf.py). Set FLASK_DEV=1 for the reloader and debugger.
+    app.run(host="0.0.0.0", port=port, debug=bool(os.getenv("FLASK_DEV")))
@@ -0,0 +1,26 @@
+# Usage: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+wsgi_app = "wsgi:application"
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+
+# Import the app (and run init_db and its migrations) once in the master
+# instead of racing in every worker. The app closes its startup SQLite
+# connection, so workers fork without any open handles and each fills its
+# own connection pool on demand.
+preload_app = True
+
+# Each worker keeps its own bcrypt pool: a forkserver plus AUTH_WORKERS
+# children, started on the first login that worker handles. The default
+# splits the cores between workers but never goes below one, so with the
+# default 2*CPU+1 workers it is one child per worker: up to 2*CPU+1 bcrypt
+# children (so at most that many hashes at once) and 2*CPU+1 idle forkservers.
+# Lower WEB_CONCURRENCY or BCRYPT_LOG_ROUNDS if logins still starve requests.
+os.environ.setdefault(
+    "AUTH_WORKERS", str(max(1, multiprocessing.cpu_count() // workers))
+)
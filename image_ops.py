@@ -0,0 +1,86 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# Optional: JIT-compile the pixel loops. Without numba they still run, just
+# as (slow) plain Python.
+#
+# The kernels are deliberately not parallel=True: they are called from
+# concurrent request threads, which numba's default workqueue threading
+# layer does not support.
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+
+@njit(cache=True)
+def floyd_steinberg(img):
+    """Dither an (H, W, C) uint8 image to pure black/white per channel."""
+    h, w, c = img.shape
+    out = np.empty_like(img)
+    for ch in range(c):
+        buf = img[:, :, ch].astype(np.float32)
+        for y in range(h):
+            for x in range(w):
+                old = buf[y, x]
+                new = 255.0 if old >= 128.0 else 0.0
+                out[y, x, ch] = np.uint8(new)
+                err = old - new
+                if x + 1 < w:
+                    buf[y, x + 1] += err * 7.0 / 16.0
+                if y + 1 < h:
+                    if x > 0:
+                        buf[y + 1, x - 1] += err * 3.0 / 16.0
+                    buf[y + 1, x] += err * 5.0 / 16.0
+                    if x + 1 < w:
+                        buf[y + 1, x + 1] += err * 1.0 / 16.0
+    return out
+
+
+@njit(cache=True)
+def threshold(img, level=128):
+    """Map every channel value to 0 or 255 around `level`."""
+    h, w, c = img.shape
+    out = np.empty_like(img)
+    for y in range(h):
+        for x in range(w):
+            for ch in range(c):
+                out[y, x, ch] = 255 if img[y, x, ch] >= level else 0
+    return out
+
+
+KERNELS = {
+    "dither": floyd_steinberg,
+    "threshold": threshold,
+}
+
+
+def postprocess_image(image_path: str, kernel: str) -> bytes:
+    """
+    Run a named kernel over the image at image_path and return it as PNG bytes.
+
+    Raises ValueError if the file is not a decodable image or is too large.
+    """
+    try:
+        with Image.open(image_path) as im:
+            rgba = im.convert("RGBA")
+    # UnidentifiedImageError and truncated-data errors are both OSErrors.
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ValueError(f"Invalid image: {exc}") from exc
+
+    # Flatten onto white so transparent sketch backgrounds don't turn black.
+    background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+    flattened = Image.alpha_composite(background, rgba).convert("RGB")
+    pixels = np.ascontiguousarray(np.asarray(flattened))
+
+    result = KERNELS[kernel](pixels)
+
+    buf = io.BytesIO()
+    Image.fromarray(result).save(buf, format="PNG")
+    return buf.getvalue()
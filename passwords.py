@@ -0,0 +1,18 @@
+"""bcrypt helpers that run in the auth process pool.
+
+Only bcrypt is imported here: the pool's children unpickle these functions by
+module name, so importing app.py instead would rerun init_db, Compress and the
+optional numpy/numba setup in every child.
+"""
+import bcrypt
+
+
+def hash_password(password: str, rounds: int) -> bytes:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds))
+
+
+def check_password(password_hash, password: str) -> bool:
+    # Hashes stored by older versions are str; newer ones are bytes.
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode("utf-8")
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """Import app.py against a throwaway database and image directory."""
+    data_dir = tmp_path_factory.mktemp("data")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("DB_PATH", str(data_dir / "app.db"))
+        mp.setenv("IMAGE_DIR", str(data_dir / "images"))
+        mp.setenv("BCRYPT_LOG_ROUNDS", "4")
+        mp.delenv("IMAGE_POSTPROCESS", raising=False)
+
+        import app
+
+        app.app.config["TESTING"] = True
+        yield app
+
+        if app.auth_executor is not None:
+            app.auth_executor.shutdown()
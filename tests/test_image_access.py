@@ -0,0 +1,44 @@
+import io
+
+SKETCH = b"\x89PNG\r\n\x1a\n"
+
+
+def login(client, username, password="pw"):
+    r = client.post("/login", data={"username": username, "password": password})
+    assert r.status_code == 302
+    return client
+
+
+def test_student_cannot_use_another_students_image(app_module):
+    app = app_module.app
+
+    teacher = app.test_client()
+    teacher.post("/register", data={"username": "teacher", "password": "pw"})
+    login(teacher, "teacher")
+    for name in ("alice", "bob"):
+        teacher.post("/register", data={"username": name, "password": "pw"})
+
+    alice = login(app.test_client(), "alice")
+    r = alice.post(
+        "/api/initial",
+        data={"prompt": "a cat", "sketch": (io.BytesIO(SKETCH), "sketch.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert r.status_code == 200
+    url = r.get_json()["inputImage"]
+    assert alice.get(url).status_code == 200
+    assert teacher.get(url).status_code == 200
+
+    bob = login(app.test_client(), "bob")
+    assert bob.get(url).status_code == 404
+
+    r = bob.post("/api/continue", json={"prompt": "mine now", "lastImage": url})
+    assert r.status_code == 400
+    assert r.get_json()["error"] == "Invalid lastImage"
+
+    r = bob.post(
+        "/api/continue",
+        json={"prompt": "mine now", "lastImage": "/images/does-not-exist.png"},
+    )
+    assert r.status_code == 400
+    assert r.get_json()["error"] == "Invalid lastImage"